@@ -18,14 +18,12 @@ import time
 import threading
 import traceback
 import csv
-import queue
-from datetime import datetime
+import atexit
+import collections
 import subprocess
 
-import ffmpeg
 import numpy as np
 import cv2
-from PIL import Image, ImageTk
 import tkinter as tk
 
 # -----------------------------
@@ -37,11 +35,48 @@ HEIGHT = 720
 CSV_FILENAME = "captures.csv"
 SAVE_COOLDOWN_SECONDS = 5.0
 FFMPEG_BUFFER_SIZE = "1024000"
+FFMPEG_PROBESIZE = "32"        # minimal probing for fast, low-latency startup
+FFMPEG_ANALYZEDURATION = "0"
+CHANGE_GATE_SIZE = (80, 45)    # thumbnail used to detect scene changes
+CHANGE_GATE_THRESHOLD = 2.0    # mean abs diff below this skips QR detection
+DETECT_EVERY_N_FRAMES = 2      # run the QR detector at most once per N frames
+ROI_MARGIN = 0.15              # grow the last QR bounding box by this per side
+ROI_MAX_MISSES = 5             # ROI misses before falling back to full frame
+FFMPEG_CPU_AFFINITY = {0, 1}   # cores ffmpeg is pinned to (Linux only)
+BACKOFF_INITIAL_SECONDS = 1.0  # first restart delay, doubled on each failure
+BACKOFF_MAX_SECONDS = 30.0
 # -----------------------------
 
+cv2.setUseOptimized(True)
+cv2.setNumThreads(max(1, (os.cpu_count() or 4) - 2))  # leave room for ffmpeg + Tk
+
 qr_detector = cv2.QRCodeDetector()
 stop_supervisor = False  # global flag to stop supervisor restart
 
+# ffmpeg command line, built once; the RTSP URL goes after "-i"
+FFMPEG_INPUT_ARGS = [
+    "ffmpeg", "-loglevel", "error",
+    "-fflags", "nobuffer", "-flags", "low_delay",
+    "-rtsp_transport", "tcp", "-buffer_size", FFMPEG_BUFFER_SIZE,
+    "-probesize", FFMPEG_PROBESIZE, "-analyzeduration", FFMPEG_ANALYZEDURATION,
+    "-i",
+]
+FFMPEG_OUTPUT_ARGS = ["-f", "rawvideo", "-pix_fmt", "nv12"]
+
+def find_qr(img):
+    """Locate, then decode, a QR code; returns (text, points) or (None, None).
+
+    The cheap detect() pass gates the sampling + error-correction work in
+    decode(), which is skipped entirely on frames without a candidate.
+    """
+    found, points = qr_detector.detect(img)
+    if not found or points is None:
+        return None, None
+    data, _ = qr_detector.decode(img, points)
+    if not data:
+        return None, None
+    return data.strip(), points.reshape((-1, 2))
+
 def ensure_csv_header(path):
     """Create CSV with header if missing."""
     if not os.path.exists(path):
@@ -60,6 +95,17 @@ class CaptureSaver:
         ensure_csv_header(self.filename)
         self.lock = threading.Lock()
 
+        # Persistent handle + writer, reused for every save
+        self.f = open(self.filename, "a", newline="", encoding="utf-8")
+        self.writer = csv.writer(self.f)
+        atexit.register(self.close)  # backstop only; close() is called per run
+
+    def close(self):
+        with self.lock:
+            if not self.f.closed:
+                self.f.close()
+        atexit.unregister(self.close)
+
     def maybe_save(self, qr_text):
         if not qr_text:
             return False
@@ -67,6 +113,9 @@ class CaptureSaver:
         now = time.time()
 
         with self.lock:
+            if self.f.closed:
+                return False
+
             should_save = False
 
             if self.last_saved_text is None:
@@ -77,9 +126,11 @@ class CaptureSaver:
                 should_save = True
 
             if should_save:
-                iso = datetime.utcnow().isoformat() + "Z"
-                with open(self.filename, "a", newline="", encoding="utf-8") as f:
-                    csv.writer(f).writerow([iso, qr_text])
+                # Formatted only when actually saving; keeps milliseconds
+                iso = (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)) +
+                       ".%03dZ" % int(now % 1 * 1000))
+                self.writer.writerow([iso, qr_text])
+                self.f.flush()
                 self.last_saved_text = qr_text
                 self.last_saved_time = now
                 return True
@@ -90,41 +141,88 @@ class CaptureSaver:
 class FFmpegReader(threading.Thread):
     """Background RTSP reader."""
 
-    def __init__(self, rtsp_url, width, height, frame_queue, stop_event):
+    def __init__(self, rtsp_url, width, height, frames, render_ready, detect_ready, stop_event):
         super().__init__(daemon=True)
         self.rtsp_url = rtsp_url
         self.width = width
         self.height = height
-        self.frame_queue = frame_queue
+        self.frames = frames
+        self.render_ready = render_ready
+        self.detect_ready = detect_ready
         self.stop_event = stop_event
         self.process = None
+        self.backoff = BACKOFF_INITIAL_SECONDS
+        self.frame_count = 0     # frames published over the reader's lifetime
+        self.argv = (FFMPEG_INPUT_ARGS + [rtsp_url] + FFMPEG_OUTPUT_ARGS +
+                     ["-vf", f"scale={width}:{height}", "pipe:1"])
+
+        # Ring of NV12 frame buffers (Y plane followed by interleaved UV at
+        # half resolution), so no per-frame allocation is needed. Frames are
+        # published as (index, version); the version is bumped when a refill
+        # starts and again when it ends, so consumers can tell whether the
+        # buffer was overwritten while they were copying out of it.
+        shape = (self.height * 3 // 2, self.width)
+        self.bufs = [np.empty(shape, np.uint8) for _ in range(3)]
+        self.versions = [0] * len(self.bufs)
+
+    def pin_process(self):
+        """Pin ffmpeg to its own cores where the OS supports it (Linux)."""
+        if not hasattr(os, "sched_setaffinity"):
+            return
+        cores = FFMPEG_CPU_AFFINITY & os.sched_getaffinity(0)
+        if not cores:
+            return
+        try:
+            os.sched_setaffinity(self.process.pid, cores)
+        except OSError as e:
+            print("[FFmpegReader] Could not set CPU affinity:", e)
+
+    def frame_intact(self, idx, version):
+        """True if buffer idx still holds the frame published as version."""
+        return self.versions[idx] == version
+
+    @staticmethod
+    def read_frame(stream, mv):
+        """Fill memoryview mv straight from the raw pipe; False on EOF/short read."""
+        off = 0
+        size = len(mv)
+        while off < size:
+            n = stream.readinto(mv[off:])
+            if not n:
+                return False
+            off += n
+        return True
+
+    def wait_backoff(self):
+        """Sleep before respawning ffmpeg, doubling the delay up to the cap."""
+        self.stop_event.wait(min(BACKOFF_MAX_SECONDS, self.backoff))
+        self.backoff = min(BACKOFF_MAX_SECONDS, self.backoff * 2)
 
     def run(self):
-        frame_size = self.width * self.height * 3
+        idx = 0
 
         while not self.stop_event.is_set():
             try:
-                self.process = (
-                    ffmpeg.input(self.rtsp_url, rtsp_transport="tcp", buffer_size=FFMPEG_BUFFER_SIZE)
-                    .output("pipe:", format="rawvideo", pix_fmt="bgr24",
-                            vf=f"scale={self.width}:{self.height}")
-                    .run_async(pipe_stdout=True, pipe_stderr=True)
-                )
+                # stderr is inherited, never piped: an unread pipe fills and stalls ffmpeg
+                self.process = subprocess.Popen(self.argv, stdout=subprocess.PIPE, bufsize=0)
 
-                stdout = self.process.stdout
+                self.pin_process()
+                stdout = self.process.stdout  # raw FileIO (bufsize=0), no extra copy
 
                 while not self.stop_event.is_set():
-                    raw = stdout.read(frame_size)
-                    if not raw or len(raw) < frame_size:
+                    self.versions[idx] += 1  # refill in progress
+                    if not self.read_frame(stdout, memoryview(self.bufs[idx]).cast("B")):
                         break
+                    self.versions[idx] += 1
 
-                    frame = np.frombuffer(raw, np.uint8).copy().reshape((self.height, self.width, 3))
-
-                    if not self.frame_queue.empty():
-                        try: self.frame_queue.get_nowait()
-                        except queue.Empty: pass
+                    self.backoff = BACKOFF_INITIAL_SECONDS
 
-                    self.frame_queue.put_nowait(frame)
+                    # maxlen=1 deque silently drops any stale frame
+                    self.frames.append((idx, self.versions[idx]))
+                    self.frame_count += 1
+                    self.render_ready.set()
+                    self.detect_ready.set()
+                    idx = (idx + 1) % len(self.bufs)
 
                 try:
                     if self.process:
@@ -133,7 +231,7 @@ class FFmpegReader(threading.Thread):
                     pass
 
                 if not self.stop_event.is_set():
-                    time.sleep(1.0)
+                    self.wait_backoff()
 
             except Exception as e:
                 print("[FFmpegReader] ERROR:", e)
@@ -145,7 +243,7 @@ class FFmpegReader(threading.Thread):
                 except:
                     pass
 
-                time.sleep(2.0)
+                self.wait_backoff()
 
         try:
             if self.process:
@@ -195,6 +293,10 @@ class QRApp:
         self.canvas = tk.Canvas(root, width=self.width, height=self.height, highlightthickness=0)
         self.canvas.pack()
 
+        # Single PhotoImage/canvas item, updated in place every frame
+        self.tk_img = tk.PhotoImage(width=self.width, height=self.height)
+        self.img_id = self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_img)
+
         # -------- Bottom Bar --------
         bottom = tk.Frame(root, bg="black")
         bottom.pack(fill=tk.X)
@@ -222,16 +324,49 @@ class QRApp:
         # Shortcuts
         root.bind("<Escape>", lambda e: self.quit_app())
         root.bind("q", lambda e: self.quit_app())
+        root.bind("<<FrameReady>>", self.on_frame)
 
         # FFmpeg reader
-        self.frame_queue = queue.Queue(maxsize=1)
+        self.frames = collections.deque(maxlen=1)
+        self.render_ready = threading.Event()  # wakes the renderer
+        self.detect_ready = threading.Event()  # wakes the detector
         self.stop_event = threading.Event()
-        self.reader = FFmpegReader(url, width, height, self.frame_queue, self.stop_event)
+        self.reader = FFmpegReader(url, width, height, self.frames,
+                                   self.render_ready, self.detect_ready, self.stop_event)
+
+        # Renderer: NV12 -> annotated PPM off the Tk thread. The finished
+        # (ppm_bytes, qr_text) pair is published in a one-slot deque.
+        self.renderer = threading.Thread(target=self.render_worker, daemon=True)
+        self.rendered = collections.deque(maxlen=1)
+        self.frame_ready = threading.Event()   # wakes the UI notifier
+
+        # Posts <<FrameReady>> to Tk; event_generate from a non-Tk thread blocks
+        # until the Tk thread runs it, so this keeps the workers from waiting on the UI
+        self.notifier = threading.Thread(target=self.notify_worker, daemon=True)
+        self.last_drawn = None
+
+        # QR detection worker, keeps the decoder off the Tk thread
+        self.detector = threading.Thread(target=self.detect_worker, daemon=True)
 
         self.saver = CaptureSaver(CSV_FILENAME, SAVE_COOLDOWN_SECONDS)
 
-        self.current_qr = ""
-        self.tk_img = None
+        # Latest detection result, written by the detector and read by the UI
+        self.qr_lock = threading.Lock()
+        self.latest_qr = ""
+        self.latest_pts = None   # last detected QR corners (full-frame coords)
+
+        # Detector-only state
+        self.gray = np.empty((height, width), np.uint8)  # private copy of the Y plane
+        self.prev_small = None   # thumbnail of the last frame with a QR hit
+        self.last_detect_count = -DETECT_EVERY_N_FRAMES  # reader frame_count at last pass
+        self.roi = None          # (x1, y1, x2, y2) search window around last QR
+        self.roi_misses = 0
+
+        # Renderer-only display buffer laid out as a binary PPM (needs Tk 8.6+):
+        # the RGB conversion writes straight into the pixel area behind the header.
+        header = f"P6\n{width} {height}\n255\n".encode("ascii")
+        self.ppm = bytearray(header) + bytearray(width * height * 3)
+        self.rgb = np.frombuffer(self.ppm, np.uint8, offset=len(header)).reshape((height, width, 3))
 
     # -------- Window Movement ----------
     def start_move(self, e): self.drag["x"], self.drag["y"] = e.x, e.y
@@ -254,85 +389,217 @@ class QRApp:
     def quit_app(self):
         global stop_supervisor
         stop_supervisor = True  # Prevent supervisor restart
+        # Threads are joined in shutdown() once mainloop has returned; joining
+        # here would block the Tk thread that a pending event_generate waits on
+        self.stop_event.set()
+        self.root.quit()
+        self.root.destroy()
+
+    def shutdown(self):
+        """Stop worker threads and ffmpeg; call after mainloop returns."""
         self.stop_event.set()
+        try:
+            if self.reader.process:
+                self.reader.process.kill()  # unblocks a pending pipe read
+        except:
+            pass
         try:
             if self.reader.is_alive():
                 self.reader.join(timeout=1.0)
+            if self.detector.is_alive():
+                self.detector.join(timeout=1.0)
+            if self.renderer.is_alive():
+                self.renderer.join(timeout=1.0)
         except:
             pass
-        self.root.quit()
-        self.root.destroy()
+        self.saver.close()
 
     def start(self):
         self.reader.start()
-        self.update_loop()
+        self.detector.start()
+        self.renderer.start()
+        self.notifier.start()
 
-    # -------- UI Loop ----------
-    def update_loop(self):
-        try:
-            frame = None
+    # -------- UI Notifier ----------
+    def notify_worker(self):
+        while not self.stop_event.is_set():
+            if not self.frame_ready.wait(timeout=0.5):
+                continue
+            self.frame_ready.clear()  # frames arriving meanwhile coalesce into one event
             try:
-                frame = self.frame_queue.get_nowait()
-            except queue.Empty:
-                pass
+                self.root.event_generate("<<FrameReady>>", when="tail")
+            except (tk.TclError, RuntimeError):
+                pass  # window closing or main loop not running yet
+
+    # -------- QR Detection ----------
+    def detect_qr(self, gray):
+        """Return (text, corners) in full-frame coords, or (None, None).
+
+        Searches the window around the last hit at full resolution first and
+        only falls back to a half-resolution full-frame scan after
+        ROI_MAX_MISSES consecutive misses.
+        """
+        if self.roi is not None:
+            x1, y1, x2, y2 = self.roi
+            qr_text, points = find_qr(gray[y1:y2, x1:x2])
+            if qr_text:
+                corners = points + (x1, y1)
+                self.roi_misses = 0
+                self.update_roi(corners)
+                return qr_text, corners
+
+            self.roi_misses += 1
+            if self.roi_misses <= ROI_MAX_MISSES:
+                return None, None
+            self.roi = None
+
+        qr_text, points = find_qr(cv2.pyrDown(gray))
+        if qr_text:
+            # Scale corners back up to full-frame coordinates
+            corners = points * 2
+            self.roi_misses = 0
+            self.update_roi(corners)
+            return qr_text, corners
+
+        return None, None
+
+    def update_roi(self, corners):
+        x1, y1 = corners.min(axis=0)
+        x2, y2 = corners.max(axis=0)
+        mx = (x2 - x1) * ROI_MARGIN
+        my = (y2 - y1) * ROI_MARGIN
+        self.roi = (max(0, int(x1 - mx)), max(0, int(y1 - my)),
+                    min(self.width, int(x2 + mx)), min(self.height, int(y2 + my)))
+
+    # -------- Detection Worker ----------
+    def detect_worker(self):
+        while not self.stop_event.is_set():
+            if not self.detect_ready.wait(timeout=0.5):
+                continue
+            self.detect_ready.clear()
 
-            if frame is not None:
-                # --- QR DETECTION ---
-                data, points, _ = qr_detector.detectAndDecode(frame)
+            try:
+                # Throttle on frames published by the reader, not on wake-ups
+                # (frames that land while detection runs coalesce into one)
+                count = self.reader.frame_count
+                if count - self.last_detect_count < DETECT_EVERY_N_FRAMES:
+                    continue
+                self.last_detect_count = count
+
+                idx, version = self.frames[-1]
+
+                # Copy the Y plane (already grayscale) so the reader can refill its buffer
+                np.copyto(self.gray, self.reader.bufs[idx][:self.height])
+                if not self.reader.frame_intact(idx, version):
+                    continue  # torn by a refill; wait for the next frame
+
+                # --- Change gate: skip detection on a static scene ---
+                thumb = cv2.resize(self.gray, CHANGE_GATE_SIZE, interpolation=cv2.INTER_AREA)
+                if (self.prev_small is None or
+                        cv2.absdiff(thumb, self.prev_small).mean() >= CHANGE_GATE_THRESHOLD):
+                    # --- QR DETECTION ---
+                    qr_text, corners = self.detect_qr(self.gray)
+
+                    # Only a hit arms the gate; after a miss keep detecting, since
+                    # e.g. a blurred first frame differs little from the sharp ones
+                    self.prev_small = thumb if qr_text else None
+
+                    with self.qr_lock:
+                        self.latest_pts = None
+                        if qr_text:
+                            self.latest_qr = qr_text
+                            self.latest_pts = corners.astype(np.int32).reshape((-1, 1, 2))
+
+                # Still visible on a static scene -> keep the cooldown re-save
+                if self.latest_pts is not None:
+                    saved = self.saver.maybe_save(self.latest_qr)
+                    if saved:
+                        print("[Saved]", self.latest_qr)
 
-                if points is not None and data:
-                    qr_text = data.strip()
+            except Exception as e:
+                print("[Detector ERROR]", e)
+                traceback.print_exc()
 
-                    pts = points.astype(int).reshape((-1, 2))
-                    for i in range(4):
-                        p1 = tuple(pts[i])
-                        p2 = tuple(pts[(i + 1) % 4])
-                        cv2.line(frame, p1, p2, (0, 255, 0), 3)
+    # -------- Render Worker ----------
+    def render_worker(self):
+        while not self.stop_event.is_set():
+            if not self.render_ready.wait(timeout=0.5):
+                continue
+            self.render_ready.clear()
 
-                    saved = self.saver.maybe_save(qr_text)
-                    if saved:
-                        print("[Saved]", qr_text)
+            try:
+                idx, version = self.frames[-1]
+                rgb = cv2.cvtColor(self.reader.bufs[idx], cv2.COLOR_YUV2RGB_NV12, dst=self.rgb)
+                if not self.reader.frame_intact(idx, version):
+                    continue  # torn by a refill; wait for the next frame
+
+                with self.qr_lock:
+                    qr_text, qr_pts = self.latest_qr, self.latest_pts
 
-                    self.current_qr = qr_text
+                if qr_pts is not None:
+                    cv2.polylines(rgb, [qr_pts], isClosed=True, color=(0, 255, 0), thickness=3)
 
-                # --- Convert to Tk image ---
-                rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pil = Image.fromarray(rgb)
-                self.tk_img = ImageTk.PhotoImage(pil)
+                self.rendered.append((bytes(self.ppm), qr_text))
+                self.frame_ready.set()
 
-                self.canvas.create_image(0, 0, anchor=tk.NW, image=self.tk_img)
+            except Exception as e:
+                print("[Renderer ERROR]", e)
+                traceback.print_exc()
+
+    # -------- Frame Handler ----------
+    def on_frame(self, event=None):
+        try:
+            frame = self.rendered[-1] if self.rendered else None
+
+            if frame is not None and frame is not self.last_drawn:
+                self.last_drawn = frame
+                ppm, qr_text = frame
+
+                # --- Blit into the existing Tk image ---
+                self.tk_img.configure(data=ppm)
 
-                label = f"Detected QR Code: {self.current_qr}" if self.current_qr else "Detected QR Code: "
+                label = f"Detected QR Code: {qr_text}" if qr_text else "Detected QR Code: "
                 self.qr_label.config(text=label)
 
         except Exception as e:
             print("[UI ERROR]", e)
             traceback.print_exc()
 
-        self.root.after(30, self.update_loop)
-
 
 # -------- Supervisor loop --------
 def supervised_run():
     global stop_supervisor
+    backoff = BACKOFF_INITIAL_SECONDS
     while not stop_supervisor:
+        app = None
         try:
             root = tk.Tk()
             app = QRApp(root, RTSP_URL, WIDTH, HEIGHT)
             app.start()
             root.mainloop()
+            app.shutdown()
 
             if stop_supervisor:
                 print("[Supervisor] Exit requested by user, stopping restart.")
                 break
 
-            print("[Supervisor] Restarting in 2 seconds...")
-            time.sleep(2)
+            if app.reader.frame_count > 0:
+                backoff = BACKOFF_INITIAL_SECONDS  # the last run got frames
+
+            print(f"[Supervisor] Restarting in {backoff:g} seconds...")
+            time.sleep(backoff)
+            backoff = min(BACKOFF_MAX_SECONDS, backoff * 2)
 
         except Exception as e:
             print("[Supervisor ERROR]", e)
             traceback.print_exc()
-            time.sleep(2)
+            if app is not None:
+                try:
+                    app.shutdown()  # release the CSV handle before restarting
+                except:
+                    pass
+            time.sleep(backoff)
+            backoff = min(BACKOFF_MAX_SECONDS, backoff * 2)
             continue
 
 